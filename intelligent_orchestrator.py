@@ -1,43 +1,88 @@
 import logging
-from app.session_manager import get_session, update_session, get_chat_history, get_stage, set_stage, clear_session_for_global_reset
+from app.session_manager import get_session, update_session, get_stage, set_stage, clear_session_for_global_reset, set_collected_info, update_conversation_context
 # --- IMPORT UPDATED HERE ---
-from .travel_payload_agent import run_travel_payload_agent
-from .quote_manager import run_quote_generation
+from .travel_payload_agent import run_travel_payload_agent, _GREETINGS
+from .quote_manager import run_quote_generation, run_quote_generation_async
 
 logger = logging.getLogger(__name__)
 
+def _commit_turn(session_id: str, session_patch: dict, user_message: str, agent_response: str) -> None:
+    """Applies the turn's session changes after all agent work has finished.
+
+    This only orders the writes: each field is still a separate store call. If the turn
+    fails before this point, nothing is written.
+    """
+    if "collected_info.payload" in session_patch:
+        set_collected_info(session_id, "payload", session_patch["collected_info.payload"])
+    context_updates = {key.split(".", 1)[1]: value for key, value in session_patch.items() if key.startswith("conversation_context.")}
+    if context_updates:
+        update_conversation_context(session_id, **context_updates)
+    if "stage" in session_patch:
+        set_stage(session_id, session_patch["stage"])
+    update_session(session_id, user_message, agent_response)
+
+def _start_conversation(user_message: str, session_id: str, normalized_message: str) -> str:
+    """Resets the session on a greeting and asks the first question."""
+    clear_session_for_global_reset(session_id)
+    # --- FUNCTION CALL UPDATED HERE ---
+    agent_response_dict = run_travel_payload_agent(user_message, [], session_id, normalized_message)
+    agent_response = agent_response_dict.get("output", "Let's begin.")
+    session_patch = {"stage": "payload_collection", **agent_response_dict.get("session_patch", {})}
+    _commit_turn(session_id, session_patch, user_message, agent_response)
+    return agent_response
+
+def _continue_conversation(user_message: str, session_id: str, normalized_message: str, stage: str) -> str:
+    """Runs one non-greeting turn for a stage the caller has already read."""
+    logger.info(f"Current stage for session {session_id}: {stage}")
+
+    if stage == "payload_collection":
+        # --- FUNCTION CALL UPDATED HERE ---
+        response_data = run_travel_payload_agent(user_message, [], session_id, normalized_message)
+        agent_response = response_data.get("output")
+        session_patch = response_data.get("session_patch", {})
+    elif stage == "quote_generation":
+        response_data = run_quote_generation(session_id)
+        agent_response = response_data.get("output")
+        session_patch = {}
+    else:
+        # --- FUNCTION CALL UPDATED HERE ---
+        response_data = run_travel_payload_agent(user_message, [], session_id, normalized_message)
+        agent_response = response_data.get("output")
+        session_patch = {"stage": "payload_collection", **response_data.get("session_patch", {})}
+
+    _commit_turn(session_id, session_patch, user_message, agent_response)
+    return agent_response
+
 def orchestrate_chat(user_message: str, session_id: str) -> str:
     """A simplified orchestrator for the payload-driven flow."""
     try:
-        if user_message.strip().lower() in ["hi", "hello"]:
-            clear_session_for_global_reset(session_id)
-            set_stage(session_id, "payload_collection")
-            # --- FUNCTION CALL UPDATED HERE ---
-            agent_response_dict = run_travel_payload_agent(user_message, [], session_id)
-            agent_response = agent_response_dict.get("output", "Let's begin.")
-            update_session(session_id, user_message, agent_response)
-            return agent_response
+        normalized_message = user_message.strip().lower()
+        if normalized_message in _GREETINGS:
+            return _start_conversation(user_message, session_id, normalized_message)
+        return _continue_conversation(user_message, session_id, normalized_message, get_stage(session_id))
+        
+    except Exception as e:
+        logger.error(f"Critical error in orchestrate_chat for session {session_id}: {str(e)}")
+        return "I'm sorry, a critical error occurred."
 
-        stage = get_stage(session_id)
-        chat_history = get_chat_history(session_id)
-        logger.info(f"Current stage for session {session_id}: {stage}")
+async def orchestrate_chat_async(user_message: str, session_id: str) -> str:
+    """Async entry point for ASGI servers: awaits the quote API instead of blocking the worker."""
+    try:
+        normalized_message = user_message.strip().lower()
+        if normalized_message in _GREETINGS:
+            return _start_conversation(user_message, session_id, normalized_message)
 
-        if stage == "payload_collection":
-            # --- FUNCTION CALL UPDATED HERE ---
-            response_data = run_travel_payload_agent(user_message, chat_history, session_id)
-            agent_response = response_data.get("output")
-        elif stage == "quote_generation":
-            response_data = run_quote_generation(session_id)
-            agent_response = response_data.get("output")
-        else:
-            set_stage(session_id, "payload_collection")
-            # --- FUNCTION CALL UPDATED HERE ---
-            response_data = run_travel_payload_agent(user_message, chat_history, session_id)
+        stage = get_stage(session_id)
+        if stage == "quote_generation":
+            logger.info(f"Current stage for session {session_id}: {stage}")
+            response_data = await run_quote_generation_async(session_id)
             agent_response = response_data.get("output")
+            _commit_turn(session_id, {}, user_message, agent_response)
+            return agent_response
+
+        # Every other stage is local work, so it runs the same way as the sync flow.
+        return _continue_conversation(user_message, session_id, normalized_message, stage)
 
-        update_session(session_id, user_message, agent_response)
-        return agent_response
-        
     except Exception as e:
-        logger.error(f"Critical error in orchestrate_chat for session {session_id}: {str(e)}")
+        logger.error(f"Critical error in orchestrate_chat_async for session {session_id}: {str(e)}")
         return "I'm sorry, a critical error occurred."
\ No newline at end of file
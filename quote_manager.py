@@ -1,9 +1,19 @@
-import logging
+import atexit
+import copy
+import hashlib
+import importlib.util
 import json
+import logging
+import threading
 import httpx
+import orjson
 import os
+import time
+from collections import OrderedDict
 from datetime import datetime
+from typing import Optional
 from app.session_manager import get_session, set_stage, get_collected_info
+from .travel_payload_agent import _json_for_log
 
 logger = logging.getLogger(__name__)
 
@@ -11,6 +21,65 @@ API_BASE_URL = os.getenv("API_BASE_URL", "https://api-sandbox.hlas.com.sg")
 QUOTE_ENDPOINT = "/api/v2/quotation/generate"
 TEST_MODE = os.getenv("TEST_MODE", "True").lower() == "false"
 
+# HTTP/2 needs the optional h2 package; without it httpx stays on HTTP/1.1 keep-alive.
+_HTTP2_ENABLED = importlib.util.find_spec("h2") is not None
+_HTTP_TIMEOUT = httpx.Timeout(15.0, connect=3.0)
+
+# Shared client so quote calls reuse pooled keep-alive connections instead of a new TLS handshake each time.
+_HTTP_CLIENT = httpx.Client(
+    http2=_HTTP2_ENABLED,
+    base_url=API_BASE_URL,
+    timeout=_HTTP_TIMEOUT,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0),
+    headers={"Content-Type": "application/json"},
+)
+atexit.register(_HTTP_CLIENT.close)
+
+# Async counterpart for ASGI callers, created on first use. Its pooled connections belong to the
+# event loop that first used it, so it assumes a single long-lived loop (one ASGI server process);
+# close it from the app's shutdown hook via close_async_http_client().
+_ASYNC_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+
+def _get_async_http_client() -> httpx.AsyncClient:
+    global _ASYNC_HTTP_CLIENT
+    if _ASYNC_HTTP_CLIENT is None or _ASYNC_HTTP_CLIENT.is_closed:
+        _ASYNC_HTTP_CLIENT = httpx.AsyncClient(
+            http2=_HTTP2_ENABLED,
+            base_url=API_BASE_URL,
+            timeout=_HTTP_TIMEOUT,
+            limits=httpx.Limits(max_keepalive_connections=50, keepalive_expiry=30.0),
+            headers={"Content-Type": "application/json"},
+        )
+    return _ASYNC_HTTP_CLIENT
+
+async def close_async_http_client() -> None:
+    """ Closes the shared async client, if it was created. Call from the app's shutdown hook. """
+    global _ASYNC_HTTP_CLIENT
+    if _ASYNC_HTTP_CLIENT is not None:
+        await _ASYNC_HTTP_CLIENT.aclose()
+        _ASYNC_HTTP_CLIENT = None
+
+# Successful quotes keyed by a hash of the canonical request; identical requests skip the round-trip.
+# Entries are (expiry, response) in insertion order, so the oldest is evicted first when full.
+_QUOTE_CACHE_MAXSIZE = 1024
+_QUOTE_CACHE_TTL = 300.0
+_QUOTE_CACHE: "OrderedDict[bytes, tuple]" = OrderedDict()
+_QUOTE_CACHE_LOCK = threading.Lock()
+
+def _quote_cache_key(quote_request: dict) -> bytes:
+    """ Hashes the request with sorted keys so equal payloads share a cache entry. """
+    try:
+        canonical = orjson.dumps(quote_request, option=orjson.OPT_SORT_KEYS)
+    except TypeError:
+        # orjson rejects values stdlib json accepts, e.g. ints beyond 64 bits; such payloads must still be quotable.
+        canonical = json.dumps(quote_request, sort_keys=True, separators=(',', ':')).encode()
+    return hashlib.blake2b(canonical, digest_size=16).digest()
+
+def clear_quote_cache() -> None:
+    """ Drops all cached quote responses. """
+    with _QUOTE_CACHE_LOCK:
+        _QUOTE_CACHE.clear()
+
 def _call_generate_quote_api_mock(quote_request: dict) -> dict:
     """ Mocks the API call with a SIMPLE response. """
     logger.warning("--- MOCK API CALL to /api/v2/quotation/generate ---")
@@ -21,28 +90,110 @@ def _call_generate_quote_api_mock(quote_request: dict) -> dict:
         "warnings": [], "errors": [],
         "data": { "premiums": { plan: {"discounted_premium": 40.5} } }
     }
-    logger.info(f"Mock API Response: {json.dumps(mock_response, indent=2)}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Mock API Response: {_json_for_log(mock_response)}")
     return mock_response
 
+def _get_cached_quote(cache_key: bytes) -> Optional[dict]:
+    """ Returns a private copy of an unexpired cached response, so callers can't alter the shared entry. """
+    with _QUOTE_CACHE_LOCK:
+        entry = _QUOTE_CACHE.get(cache_key)
+        if entry is None:
+            return None
+        expires_at, cached = entry
+        if expires_at <= time.monotonic():
+            del _QUOTE_CACHE[cache_key]
+            return None
+    logger.info("--- Returning cached quote response ---")
+    return copy.deepcopy(cached)
+
+def _store_cached_quote(cache_key: bytes, response_data: dict) -> None:
+    entry = (time.monotonic() + _QUOTE_CACHE_TTL, copy.deepcopy(response_data))
+    with _QUOTE_CACHE_LOCK:
+        _QUOTE_CACHE[cache_key] = entry
+        _QUOTE_CACHE.move_to_end(cache_key)
+        while len(_QUOTE_CACHE) > _QUOTE_CACHE_MAXSIZE:
+            _QUOTE_CACHE.popitem(last=False)
+
+def _handle_quote_response(response: httpx.Response, cache_key: bytes) -> dict:
+    """ Validates and decodes an API response, caching it if the quote succeeded. """
+    response.raise_for_status() 
+    response_data = orjson.loads(response.content)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Real API Response: {_json_for_log(response_data)}")
+    if response_data.get("success") in ["ok", "true"]:
+        _store_cached_quote(cache_key, response_data)
+    return response_data
+
+def _quote_error_response(e: Exception) -> dict:
+    if isinstance(e, httpx.HTTPStatusError):
+        logger.error(f"HTTP error calling quote API: {e.response.status_code} - {e.response.text}")
+        return {"success": "false", "errors": [f"HTTP error: {e.response.status_code}"]}
+    logger.error(f"Unknown error calling quote API: {e}")
+    return {"success": "false", "errors": [f"Unknown error: {e}"]}
+
 def _call_generate_quote_api(quote_request: dict) -> dict:
     """ Calls the REAL quotation API or returns a mock if in Test Mode. """
     if TEST_MODE:
         return _call_generate_quote_api_mock(quote_request)
     
+    cache_key = _quote_cache_key(quote_request)
+    cached = _get_cached_quote(cache_key)
+    if cached is not None:
+        return cached
+
     logger.info(f"--- Calling REAL API: {API_BASE_URL}{QUOTE_ENDPOINT} ---")
     try:
-        with httpx.Client(timeout=15.0) as client:
-            response = client.post(f"{API_BASE_URL}{QUOTE_ENDPOINT}", json=quote_request)
-            response.raise_for_status() 
-            response_data = response.json()
-            logger.info(f"Real API Response: {json.dumps(response_data, indent=2)}")
-            return response_data
-    except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP error calling quote API: {e.response.status_code} - {e.response.text}")
-        return {"success": "false", "errors": [f"HTTP error: {e.response.status_code}"]}
+        response = _HTTP_CLIENT.post(QUOTE_ENDPOINT, json=quote_request)
+        return _handle_quote_response(response, cache_key)
+    except Exception as e:
+        return _quote_error_response(e)
+
+async def _call_generate_quote_api_async(quote_request: dict) -> dict:
+    """ Async version of _call_generate_quote_api; awaits the API without blocking the event loop. """
+    if TEST_MODE:
+        return _call_generate_quote_api_mock(quote_request)
+
+    cache_key = _quote_cache_key(quote_request)
+    cached = _get_cached_quote(cache_key)
+    if cached is not None:
+        return cached
+
+    logger.info(f"--- Calling REAL API (async): {API_BASE_URL}{QUOTE_ENDPOINT} ---")
+    try:
+        response = await _get_async_http_client().post(QUOTE_ENDPOINT, json=quote_request)
+        return _handle_quote_response(response, cache_key)
     except Exception as e:
-        logger.error(f"Unknown error calling quote API: {e}")
-        return {"success": "false", "errors": [f"Unknown error: {e}"]}
+        return _quote_error_response(e)
+
+def _build_quote_output(session_id: str, final_payload: dict, quote_response: dict) -> dict:
+    """ Turns a quote API response into the user-facing message. """
+    if quote_response.get("success") not in ["ok", "true"]:
+        errors = quote_response.get("errors", ["Unknown API error"])
+        return {"output": f"Sorry, there was an error getting the quote: {errors[0]}"}
+    
+    # --- NEW ROBUST PARSING LOGIC ---
+    plan_tier = final_payload.get("travel", {}).get("plan", "basic")
+    price_str = "Price not available"
+    
+    # Safely navigate the nested JSON response to find the price
+    data = quote_response.get("data")
+    if data and isinstance(data, dict):
+        premiums = data.get("premiums")
+        if premiums and isinstance(premiums, dict):
+            plan_info = premiums.get(plan_tier.lower())
+            if plan_info and isinstance(plan_info, dict):
+                final_price = plan_info.get("discounted_premium")
+                # Safely format the price into a string
+                try:
+                    price_str = f"S${float(final_price):.2f}"
+                except (ValueError, TypeError):
+                    logger.warning(f"Could not format price: {final_price}")
+    
+    final_message = f"Your quote for the **{plan_tier.capitalize()} Plan** has been generated. The premium is **{price_str}**."
+    
+    set_stage(session_id, "initial") # Reset for a new conversation
+    return {"output": final_message}
 
 def run_quote_generation(session_id: str) -> dict:
     """ 
@@ -57,35 +208,29 @@ def run_quote_generation(session_id: str) -> dict:
             return {"output": "I seem to have lost your details. Let's start over."}
 
         quote_response = _call_generate_quote_api(final_payload)
-        
-        if quote_response.get("success") not in ["ok", "true"]:
-            errors = quote_response.get("errors", ["Unknown API error"])
-            return {"output": f"Sorry, there was an error getting the quote: {errors[0]}"}
-        
-        # --- NEW ROBUST PARSING LOGIC ---
-        plan_tier = final_payload.get("travel", {}).get("plan", "basic")
-        price_str = "Price not available"
-        
-        # Safely navigate the nested JSON response to find the price
-        data = quote_response.get("data")
-        if data and isinstance(data, dict):
-            premiums = data.get("premiums")
-            if premiums and isinstance(premiums, dict):
-                plan_info = premiums.get(plan_tier.lower())
-                if plan_info and isinstance(plan_info, dict):
-                    final_price = plan_info.get("discounted_premium")
-                    # Safely format the price into a string
-                    try:
-                        price_str = f"S${float(final_price):.2f}"
-                    except (ValueError, TypeError):
-                        logger.warning(f"Could not format price: {final_price}")
-        
-        final_message = f"Your quote for the **{plan_tier.capitalize()} Plan** has been generated. The premium is **{price_str}**."
-        
-        set_stage(session_id, "initial") # Reset for a new conversation
-        return {"output": final_message}
+        return _build_quote_output(session_id, final_payload, quote_response)
 
     except Exception as e:
         logger.error(f"Error in run_quote_generation for session {session_id}: {str(e)}")
         set_stage(session_id, "initial") 
+        return {"output": "I'm sorry, I ran into an error while generating your quote."}
+
+async def run_quote_generation_async(session_id: str) -> dict:
+    """ 
+    Async version of run_quote_generation for use under an ASGI server.
+    """
+    try:
+        collected_info = get_collected_info(session_id)
+        final_payload = collected_info.get("payload")
+
+        if not final_payload:
+            set_stage(session_id, "payload_collection") 
+            return {"output": "I seem to have lost your details. Let's start over."}
+
+        quote_response = await _call_generate_quote_api_async(final_payload)
+        return _build_quote_output(session_id, final_payload, quote_response)
+
+    except Exception as e:
+        logger.error(f"Error in run_quote_generation_async for session {session_id}: {str(e)}")
+        set_stage(session_id, "initial") 
         return {"output": "I'm sorry, I ran into an error while generating your quote."}
\ No newline at end of file
@@ -1,68 +1,190 @@
 import logging
 import json
-from dpath import set as dpath_set, get as dpath_get
+import orjson
+import re
 from typing import Optional
-from datetime import datetime
+from datetime import date
 
-from app.config import llm
-from langchain_core.messages import SystemMessage, HumanMessage
-from app.session_manager import get_session, set_collected_info, set_stage, update_conversation_context
+from app.session_manager import get_session
 
 logger = logging.getLogger(__name__)
 
-def get_payload_template() -> dict:
-    """Returns the master JSON payload structure as a Python dictionary."""
-    return {
-        "_internal": { "start_date": None, "end_date": None },
-        "ProductCode": "TVP",
-        "media": {"wcc": "HLS"},
-        "travel": {
-            "policy_type": None, "country_code": [], "number_of_days": None,
-            "zone": None, "with_children": None, "with_spouse": "no",
-            "with_group_of_adults": None, "with_group_of_households": "no",
-            "plan": "basic",
-            "selectedAddOns": {
-                "preExAddOn": {"selected": None, "preselected": False},
-                "lossFFMAddOn": {"selected": None, "preselected": False},
-                "flightDelayAddOn": {"selected": None, "preselected": False}
-            },
-            "number_of_travellers": { "total": None, "child": [], "adult": [], "group": 1 }
+# Messages that (re)start the conversation rather than answer the pending question.
+_GREETINGS = frozenset({"hi", "hello", "hey", "hola"})
+# Accepts the same YYYY-MM-DD (optionally unpadded month/day) strings as strptime's "%Y-%m-%d".
+_DATE_RE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+
+_PAYLOAD_TEMPLATE_JSON = json.dumps({
+    "_internal": { "start_date": None, "end_date": None },
+    "ProductCode": "TVP",
+    "media": {"wcc": "HLS"},
+    "travel": {
+        "policy_type": None, "country_code": [], "number_of_days": None,
+        "zone": None, "with_children": None, "with_spouse": "no",
+        "with_group_of_adults": None, "with_group_of_households": "no",
+        "plan": "basic",
+        "selectedAddOns": {
+            "preExAddOn": {"selected": None, "preselected": False},
+            "lossFFMAddOn": {"selected": None, "preselected": False},
+            "flightDelayAddOn": {"selected": None, "preselected": False}
         },
-        "promotion": {"coupon_code": None},
-        "leads": { "email": None, "contact_mobile": None },
-        "CEPParams": {}
-    }
+        "number_of_travellers": { "total": None, "child": [], "adult": [], "group": 1 }
+    },
+    "promotion": {"coupon_code": None},
+    "leads": { "email": None, "contact_mobile": None },
+    "CEPParams": {}
+})
+
+_QUESTION_MAP = {
+    'travel/policy_type': "To start, what is the policy type? (Enter 'S' for Single Trip or 'A' for Annual)",
+    '_internal/start_date': "What is your travel start date (YYYY-MM-DD)?",
+    '_internal/end_date': "And what is your travel end date (YYYY-MM-DD)?",
+    'travel/country_code': "What is the 3-letter country code for your destination (e.g., 'MAL')?",
+    'travel/number_of_travellers/adult': "How many adults are traveling?",
+    'travel/number_of_travellers/child': "How many children are traveling?",
+    'travel/selectedAddOns/preExAddOn/selected': "Do you require coverage for pre-existing conditions? (true/false)",
+    'travel/selectedAddOns/lossFFMAddOn/selected': "Add coverage for Loss of Frequent Flyer Miles? (true/false)",
+    'travel/selectedAddOns/flightDelayAddOn/selected': "Add the Flight Delay benefit? (true/false)",
+    'leads/email': "What is your email address?",
+    'leads/contact_mobile': "What is your 8-digit contact mobile number?",
+    'promotion/coupon_code': "Finally, do you have a coupon code? (If not, just say 'no')",
+}
+_QUESTION_KEYS = tuple(_QUESTION_MAP.keys())
+# The schema is static, so split each 'a/b/c' key into its path segments once.
+_KEY_PATHS = {key: tuple(key.split('/')) for key in _QUESTION_KEYS}
+_KEY_SEGMENTS = tuple(_KEY_PATHS[key] for key in _QUESTION_KEYS)
+
+def _walk(payload: dict, segments: tuple):
+    """Returns the value at the given path, or None if any segment is missing."""
+    for segment in segments:
+        payload = payload.get(segment)
+        if payload is None: return None
+    return payload
+
+def _set_by_path(payload: dict, key: str, value) -> None:
+    """Assigns value at a question key's path. Raises KeyError if a parent is missing."""
+    *parents, leaf = _KEY_PATHS[key]
+    for segment in parents:
+        payload = payload[segment]
+    payload[leaf] = value
+
+def _compile_first_unfilled():
+    """Generates a straight-line function returning the index of the first unfilled question key.
+
+    Each key's lookups are inlined as chained dict.get calls, so a full scan runs without
+    the per-key loop and tuple iteration of _walk. Missing or None parents count as unfilled.
+    """
+    lines = ["def _first_unfilled(p):"]
+    for index, segments in enumerate(_KEY_SEGMENTS):
+        expr = f"p.get({segments[0]!r})"
+        for segment in segments[1:]:
+            expr = f"({expr} or _EMPTY).get({segment!r})"
+        lines.append(f"    v = {expr}")
+        lines.append(f"    if v is None or v == []: return {index}")
+    lines.append("    return None")
+    namespace = {"_EMPTY": {}}
+    exec(compile("\n".join(lines), "<_first_unfilled>", "exec"), namespace)
+    return namespace["_first_unfilled"]
+
+_first_unfilled = _compile_first_unfilled()
+
+def _json_for_log(obj) -> str:
+    """Pretty-prints obj for logging, falling back to stdlib json for values orjson rejects (e.g. ints beyond 64 bits)."""
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    except TypeError:
+        return json.dumps(obj, indent=2, default=str)
+
+def _parse_date(date_str: str) -> date:
+    """Parses a YYYY-MM-DD string. Raises ValueError for bad formats or impossible calendar dates."""
+    match = _DATE_RE.fullmatch(date_str)
+    if not match: raise ValueError(f"not a YYYY-MM-DD date: {date_str}")
+    return date(*map(int, match.groups()))
+
+def _internal_date_ordinal(internal: dict, name: str) -> Optional[int]:
+    """Returns the stored ordinal for start_date/end_date, parsing the string for sessions saved before ordinals existed."""
+    ordinal = internal.get(f"{name}_ordinal")
+    if ordinal is None and internal.get(name):
+        try:
+            ordinal = _parse_date(internal[name]).toordinal()
+        except ValueError:
+            logger.warning(f"Could not parse stored {name}: {internal[name]}")
+    return ordinal
+
+def _coerce_default(answer: str, low: str):
+    """Turns 'true'/'false' into booleans and digit strings into ints; anything else is kept as typed."""
+    if low in ('true', 'false'): return low == 'true'
+    if answer.isdigit(): return int(answer)
+    return answer
+
+def _coerce_policy_type(answer: str, low: str):
+    if low == 's': return 'single'
+    if low == 'a': return 'annual'
+    return answer
+
+def _coerce_country_code(answer: str, low: str):
+    # Digit and true/false answers aren't country codes; raising leaves the key unset so it is asked again.
+    value = _coerce_default(answer, low)
+    if not isinstance(value, str): raise ValueError(f"not a country code: {answer}")
+    return [value.upper()]
+
+def _coerce_traveller_count(answer: str, low: str):
+    return [_coerce_default(answer, low)]
+
+def _coerce_coupon_code(answer: str, low: str):
+    return "" if low == 'no' else _coerce_default(answer, low)
+
+# Keys whose answers need more than _coerce_default before being stored.
+_COERCERS = {
+    'travel/policy_type': _coerce_policy_type,
+    'travel/country_code': _coerce_country_code,
+    'travel/number_of_travellers/adult': _coerce_traveller_count,
+    'travel/number_of_travellers/child': _coerce_traveller_count,
+    'promotion/coupon_code': _coerce_coupon_code,
+}
+_TRAVELLER_KEYS = frozenset({'travel/number_of_travellers/adult', 'travel/number_of_travellers/child'})
+
+def _update_traveller_totals(payload: dict) -> None:
+    """Recomputes the fields derived from the adult and child counts."""
+    travel = payload['travel']
+    nt = travel['number_of_travellers']
+    adults = nt['adult'][0] if nt['adult'] else 0
+    children = nt['child'][0] if nt['child'] else 0
+    nt['total'] = adults + children
+    travel['with_children'] = "yes" if children > 0 else "no"
+    travel['with_group_of_adults'] = "yes" if adults > 1 else "no"
+
+def get_payload_template() -> dict:
+    """Returns a fresh copy of the master JSON payload structure as a Python dictionary."""
+    return json.loads(_PAYLOAD_TEMPLATE_JSON)
 
 def get_question_map() -> dict:
-    """Maps payload keys to user-facing questions."""
-    return {
-        'travel/policy_type': "To start, what is the policy type? (Enter 'S' for Single Trip or 'A' for Annual)",
-        '_internal/start_date': "What is your travel start date (YYYY-MM-DD)?",
-        '_internal/end_date': "And what is your travel end date (YYYY-MM-DD)?",
-        'travel/country_code': "What is the 3-letter country code for your destination (e.g., 'MAL')?",
-        'travel/number_of_travellers/adult': "How many adults are traveling?",
-        'travel/number_of_travellers/child': "How many children are traveling?",
-        'travel/selectedAddOns/preExAddOn/selected': "Do you require coverage for pre-existing conditions? (true/false)",
-        'travel/selectedAddOns/lossFFMAddOn/selected': "Add coverage for Loss of Frequent Flyer Miles? (true/false)",
-        'travel/selectedAddOns/flightDelayAddOn/selected': "Add the Flight Delay benefit? (true/false)",
-        'leads/email': "What is your email address?",
-        'leads/contact_mobile': "What is your 8-digit contact mobile number?",
-        'promotion/coupon_code': "Finally, do you have a coupon code? (If not, just say 'no')",
-    }
+    """Maps payload keys to user-facing questions. The returned dict is shared; do not mutate it."""
+    return _QUESTION_MAP
+
+def _find_next_question_index(payload: dict, start: int = 0) -> Optional[int]:
+    """Finds the index in _QUESTION_KEYS of the first unfilled key at or after start."""
+    if start == 0:
+        return _first_unfilled(payload)
+    key_segments, walk = _KEY_SEGMENTS, _walk
+    for index in range(start, len(key_segments)):
+        value = walk(payload, key_segments[index])
+        if value is None or value == []: return index
+    return None
 
 def find_next_question_key(payload: dict) -> Optional[str]:
     """Finds the first key in the payload that needs to be filled."""
-    for key in get_question_map().keys():
-        try:
-            value = dpath_get(payload, key)
-            if value is None or value == []: return key
-        except KeyError: return key
-    return None
+    index = _find_next_question_index(payload)
+    return _QUESTION_KEYS[index] if index is not None else None
 
-def run_travel_payload_agent(user_message: str, chat_history: list, session_id: str) -> dict:
+def run_travel_payload_agent(user_message: str, chat_history: list, session_id: str, normalized_message: Optional[str] = None) -> dict:
+    if normalized_message is None:
+        normalized_message = user_message.strip().lower()
     session = get_session(session_id)
     collected_info = session.get("collected_info", {})
     payload = collected_info.get("payload")
+    payload_from_session = payload is not None
+    answer_applied = False
 
     if payload is None:
         payload = get_payload_template()
@@ -70,79 +192,76 @@ def run_travel_payload_agent(user_message: str, chat_history: list, session_id:
     context = session.get("conversation_context", {})
     last_question_key = context.get("last_question_key")
 
-    if last_question_key and user_message.strip().lower() not in ["hi", "hello"]:
+    if last_question_key and normalized_message not in _GREETINGS:
         answer = user_message.strip()
 
         # --- Step 1: Validate input before processing ---
         if last_question_key in ['_internal/start_date', '_internal/end_date']:
             try:
                 date_str = answer.replace('/', '-')
-                datetime.strptime(date_str, "%Y-%m-%d")
+                parsed = _parse_date(date_str)
+                # Keep the ordinal alongside the string so finalizing doesn't need to re-parse.
+                # A finalized payload has no '_internal', so rebuild it when collection restarts.
+                payload.setdefault('_internal', {})[last_question_key.split('/')[-1] + '_ordinal'] = parsed.toordinal()
                 answer = date_str
             except ValueError:
                 logger.warning(f"Invalid date format received: {user_message}")
-                question_map = get_question_map()
-                re_ask_question = question_map[last_question_key]
+                re_ask_question = _QUESTION_MAP[last_question_key]
                 return {"output": f"That doesn't look like a valid date format. Please use YYYY-MM-DD.\n\n{re_ask_question}"}
 
         # --- Step 2: Process and save the validated answer ---
         try:
-            if last_question_key == 'travel/policy_type':
-                if answer.lower() == 's': answer = 'single'
-                elif answer.lower() == 'a': answer = 'annual'
-            elif answer.lower() in ['true', 'false']:
-                answer = answer.lower() == 'true'
-            elif answer.lower() == 'no' and last_question_key == 'promotion/coupon_code':
-                answer = ""
-            elif answer.isdigit():
-                answer = int(answer)
-            
-            if last_question_key in ['travel/number_of_travellers/adult', 'travel/number_of_travellers/child']:
-                if last_question_key == 'travel/number_of_travellers/adult': payload['travel']['number_of_travellers']['adult'] = [answer]
-                else: payload['travel']['number_of_travellers']['child'] = [answer]
-                
-                adults = payload['travel']['number_of_travellers']['adult'][0] if payload['travel']['number_of_travellers']['adult'] else 0
-                children = payload['travel']['number_of_travellers']['child'][0] if payload['travel']['number_of_travellers']['child'] else 0
-                payload['travel']['number_of_travellers']['total'] = adults + children
-                payload['travel']['with_children'] = "yes" if children > 0 else "no"
-                payload['travel']['with_group_of_adults'] = "yes" if adults > 1 else "no"
-            elif last_question_key == 'travel/country_code':
-                dpath_set(payload, last_question_key, [answer.upper()])
-            else:
-                dpath_set(payload, last_question_key, answer)
+            coercer = _COERCERS.get(last_question_key, _coerce_default)
+            _set_by_path(payload, last_question_key, coercer(answer, answer.lower()))
+            answer_applied = True
+            if last_question_key in _TRAVELLER_KEYS:
+                _update_traveller_totals(payload)
             
             logger.info(f"Payload updated for key '{last_question_key}'")
         except Exception as e:
             logger.error(f"Failed to set key {last_question_key} with value {user_message}: {e}")
 
     # --- Step 3: Find the next question ---
-    next_key = find_next_question_key(payload)
-    set_collected_info(session_id, "payload", payload)
+    # Questions are answered in order, so every key before the pending one is already filled and
+    # the scan can resume there. That only holds for a stored payload that just took an answer;
+    # a fresh template, a rejected answer or a stale index falls back to a full scan.
+    frontier = context.get("next_question_index")
+    if (not (payload_from_session and answer_applied) or frontier is None
+            or frontier >= len(_QUESTION_KEYS) or _QUESTION_KEYS[frontier] != last_question_key):
+        frontier = 0
+    next_index = _find_next_question_index(payload, frontier)
+    next_key = _QUESTION_KEYS[next_index] if next_index is not None else None
 
     if next_key:
-        question_map = get_question_map()
-        next_question = question_map[next_key]
-        update_conversation_context(session_id, last_question_key=next_key)
-        return {"output": next_question}
+        output = _QUESTION_MAP[next_key]
     else:
         # --- Step 4: Finalize payload and finish ---
-        start_str = payload.get("_internal", {}).get("start_date")
-        end_str = payload.get("_internal", {}).get("end_date")
-        if start_str and end_str:
-            start = datetime.strptime(start_str, "%Y-%m-%d").date()
-            end = datetime.strptime(end_str, "%Y-%m-%d").date()
-            num_days = max((end - start).days + 1, 1)
+        internal = payload.get("_internal", {})
+        start_ord = _internal_date_ordinal(internal, "start_date")
+        end_ord = _internal_date_ordinal(internal, "end_date")
+        if start_ord and end_ord:
+            num_days = max(end_ord - start_ord + 1, 1)
             payload['travel']['number_of_days'] = num_days
             logger.info(f"Final calculation: number_of_days set to {num_days}")
 
         if '_internal' in payload: del payload['_internal']
         
-        set_collected_info(session_id, "payload", payload)
-        
-        logger.info("--- FINAL POPULATED PAYLOAD ---")
-        logger.info(json.dumps(payload, indent=4))
-        logger.info("--- END OF PAYLOAD ---")
-        
-        set_stage(session_id, "quote_generation")
-        update_conversation_context(session_id, last_question_key=None)
-        return {"output": "Thank you, I have all the information. Generating your quote now..."}
\ No newline at end of file
+        # The session patch below must still be returned, so a logging failure must not end the turn.
+        if logger.isEnabledFor(logging.INFO):
+            try:
+                logger.info("--- FINAL POPULATED PAYLOAD ---")
+                logger.info(_json_for_log(payload))
+                logger.info("--- END OF PAYLOAD ---")
+            except Exception as e:
+                logger.warning(f"Could not log final payload: {e}")
+        output = "Thank you, I have all the information. Generating your quote now..."
+
+    # --- Step 5: Hand the session changes back; the orchestrator writes them after the turn's work ---
+    session_patch = {
+        "collected_info.payload": payload,
+        "conversation_context.last_question_key": next_key,
+        "conversation_context.next_question_index": next_index,
+    }
+    if not next_key:
+        session_patch["stage"] = "quote_generation"
+    return {"output": output, "session_patch": session_patch}
\ No newline at end of file